@@ -0,0 +1,152 @@
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, as_completed
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import Dict, List, Optional
+from synchronize import BookmarkSynchronizer
+from download import ImageCache
+from requests.adapters import HTTPAdapter
+import requests
+import sys
+import threading
+
+NUM_BATCH_WORKERS = 8
+MAX_CONCURRENT_ACCOUNTS = 8
+
+class FairExecutor(object):
+    """Worker threads shared by several accounts. Tasks are taken from the accounts in turn,
+    so an account with many downloads does not hold up the others."""
+
+    def __init__(self, max_workers: int):
+        self.queues : "OrderedDict[str, deque]" = OrderedDict()
+        self.condition = threading.Condition()
+        self.is_shutdown = False
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(max_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def for_account(self, account: str) -> "AccountExecutor":
+        return AccountExecutor(self, account)
+
+    def submit(self, account: str, fn, *args, **kwargs) -> Future:
+        future = Future()
+        with self.condition:
+            if self.is_shutdown:
+                raise RuntimeError('cannot schedule new tasks after shutdown')
+            self.queues.setdefault(account, deque()).append((future, fn, args, kwargs))
+            self.condition.notify()
+        return future
+
+    def next_task(self):
+        with self.condition:
+            while not self.queues and not self.is_shutdown:
+                self.condition.wait()
+            if not self.queues:
+                return None
+            account, queue = next(iter(self.queues.items()))
+            task = queue.popleft()
+            # Put the account at the end, so the next task is taken from the next account
+            del self.queues[account]
+            if queue:
+                self.queues[account] = queue
+            return task
+
+    def work(self):
+        while True:
+            task = self.next_task()
+            if task is None:
+                return
+            future, fn, args, kwargs = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def shutdown(self, wait: bool = True):
+        """Stop the workers once all queued tasks are done."""
+        with self.condition:
+            self.is_shutdown = True
+            self.condition.notify_all()
+        if wait:
+            for worker in self.workers:
+                worker.join()
+
+
+class AccountExecutor(Executor):
+    """The view of a single account on a FairExecutor."""
+
+    def __init__(self, fair_executor: FairExecutor, account: str):
+        self.fair_executor = fair_executor
+        self.account = account
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        return self.fair_executor.submit(self.account, fn, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True, **kwargs):
+        # The workers are shared with other accounts, they are shut down by the batch synchronizer
+        pass
+
+
+class BatchSynchronizer(object):
+    """Synchronizes several accounts in one process. Each account folder contains the config files,
+    books, and index of the account, just like the working directory of a single synchronization.
+    The accounts share the download workers, the http connection pool, and the image cache."""
+
+    def __init__(self, account_folders: List[Path],
+                 num_workers: int = NUM_BATCH_WORKERS,
+                 tmp_images_folder: Path = Path('./tmp_images')):
+        self.account_folders = account_folders
+        self.num_workers = num_workers
+        self.tmp_images_folder = tmp_images_folder
+
+    def synchronize(self) -> Dict[Path, Optional[Exception]]:
+        """Synchronize all accounts and return the error of each account, if any.
+        A failing account does not stop the synchronization of the others."""
+        image_cache = ImageCache(self.tmp_images_folder)
+        executor = FairExecutor(self.num_workers)
+        http = self.create_http_session()
+        results : Dict[Path, Optional[Exception]] = {}
+        try:
+            with ThreadPoolExecutor(max_workers=min(len(self.account_folders), MAX_CONCURRENT_ACCOUNTS) or 1) as accounts:
+                futures = {accounts.submit(self.synchronize_account, folder, executor, http, image_cache): folder
+                           for folder in self.account_folders}
+                for future in as_completed(futures):
+                    folder = futures[future]
+                    try:
+                        future.result()
+                        results[folder] = None
+                    except Exception as e:
+                        print(f"Synchronization of {folder} failed: {e}", file=sys.stderr)
+                        results[folder] = e
+        finally:
+            executor.shutdown()
+            http.close()
+        return results
+
+    def create_http_session(self) -> requests.Session:
+        http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.num_workers, pool_maxsize=self.num_workers)
+        http.mount('http://', adapter)
+        http.mount('https://', adapter)
+        return http
+
+    def synchronize_account(self, account_folder: Path, executor: FairExecutor, http: requests.Session, image_cache: ImageCache):
+        synchronizer = BookmarkSynchronizer(account_folder,
+                                            executor=executor.for_account(str(account_folder)),
+                                            http=http,
+                                            image_cache=image_cache)
+        synchronizer.login()
+        synchronizer.synchronize()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit(f"Usage: {sys.argv[0]} account_folder [account_folder ...]")
+
+    batch_synchronizer = BatchSynchronizer([Path(folder) for folder in sys.argv[1:]])
+    results = batch_synchronizer.synchronize()
+    if any(results.values()):
+        sys.exit(1)
@@ -2,7 +2,8 @@ from instapaper import Instapaper, Bookmark
 from ebooklib import epub
 from pathlib import Path
 from bs4 import BeautifulSoup
-from PIL import Image
+from PIL import Image, ImageFile
+from concurrent.futures import Future
 import requests
 import json
 import string
@@ -10,22 +11,123 @@ import sys
 import io
 import mimetypes as mime
 import hashlib
+import uuid
+import zipfile
+import datetime
+import threading
 from urllib.parse import urlparse
-from typing import Optional
+from typing import Callable, Dict, Optional
 
 BOOK_FILE_PREFIX = "InPa"
+MAX_IMAGE_BYTES = 10 * 1024 * 1024 # Images larger than this are replaced by their alt text
+IMAGE_PROBE_BYTES = 64 * 1024 # Amount of data within which the image header has to be found
+MAX_IMAGE_PIXELS = 50_000_000 # Images with more pixels are rejected before being downloaded completely
+MAX_IMAGE_DIMENSIONS = (1200, 1600) # Roughly the resolution of common ebook readers
+IMAGE_CHUNK_SIZE = 16 * 1024
+IMAGE_REQUEST_TIMEOUT = 30
+EPUB_TIMESTAMP = datetime.datetime(1980, 1, 1) # Fixed for all books, so that unchanged books are byte-identical
+COMPRESSED_MEDIA_TYPES = ('image/jpeg', 'image/png', 'image/gif') # Stored instead of deflated, as deflating gains nothing
+
+class DeterministicZipFile(zipfile.ZipFile):
+    """Zip file whose bytes only depend on the written entries: timestamps and attributes are fixed
+    and entries that are already compressed are stored instead of deflated."""
+
+    def writestr(self, zinfo_or_arcname, data, compress_type=None, compresslevel=None):
+        if isinstance(zinfo_or_arcname, zipfile.ZipInfo):
+            return super().writestr(zinfo_or_arcname, data, compress_type, compresslevel)
+
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        zinfo = zipfile.ZipInfo(zinfo_or_arcname, date_time=EPUB_TIMESTAMP.timetuple()[:6])
+        zinfo.create_system = 3
+        zinfo.external_attr = 0o644 << 16
+        zinfo.compress_type = compress_type if compress_type is not None else self.compress_type_for(zinfo_or_arcname)
+        # Unlike for names, ZipFile.writestr does not apply the compression level of the archive to a ZipInfo
+        return super().writestr(zinfo, data, compresslevel=compresslevel if compresslevel is not None else self.compresslevel)
+
+    def compress_type_for(self, file_name: str) -> int:
+        if mime.guess_type(file_name)[0] in COMPRESSED_MEDIA_TYPES:
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+
+class DeterministicEpubWriter(epub.EpubWriter):
+
+    def __init__(self, name, book, options=None):
+        options = dict(options) if options else {}
+        options.setdefault('mtime', EPUB_TIMESTAMP)
+        super().__init__(name, book, options)
+
+    def write(self):
+        # Same as EpubWriter.write of the EbookLib versions in requirements.txt, but using DeterministicZipFile
+        if not all(hasattr(self, name) for name in ('_write_container', '_write_opf', '_write_items')):
+            print('Unsupported EbookLib version, books are not written reproducibly.', file=sys.stderr)
+            return super().write()
+
+        self.out = DeterministicZipFile(self.file_name, 'w', zipfile.ZIP_DEFLATED, compresslevel=self.options.get('compresslevel'))
+        self.out.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+
+        self._write_container()
+        self._write_opf()
+        self._write_items()
+
+        self.out.close()
+
+
+class ImageCache(object):
+    """Converted images stored in a folder. The cache can be shared by several downloaders in one process,
+    an image requested by several of them at the same time is only fetched once."""
+
+    def __init__(self, folder: Path):
+        self.folder = folder
+        self.folder.mkdir(exist_ok=True)
+        self.lock = threading.Lock()
+        self.in_flight : Dict[str, Future] = {}
+
+    def get(self, file_name: str, create: Callable[[], bytes]) -> bytes:
+        file_path = self.folder / file_name
+        with self.lock:
+            future = self.in_flight.get(file_name)
+            is_creator = future is None and not file_path.exists()
+            if is_creator:
+                future = self.in_flight[file_name] = Future()
+
+        if future is None:
+            return file_path.read_bytes()
+        if not is_creator:
+            # Someone else is already fetching the image, wait for it
+            return future.result()
+
+        try:
+            image_data = create()
+            # Write to a temporary file first, so other processes never read a partially written image
+            tmp_file_path = file_path.with_name(f'{file_path.name}.{uuid.uuid4().hex}.part')
+            tmp_file_path.write_bytes(image_data)
+            tmp_file_path.replace(file_path)
+            future.set_result(image_data)
+            return image_data
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[file_name]
+
 
 class ExtendedBookmark(object):
     _book_file_name: str
     _original_title: str
     _bookmark_id: str
+    _html: Optional[str]
     sanitized_content: str
 
-    def __init__(self, bookmark: Bookmark):
+    def __init__(self, bookmark: Bookmark, html: Optional[str] = None):
+        """html can be passed in if it was already fetched, otherwise it is fetched from the API."""
         self.bookmark = bookmark
         self._book_file_name = ""
         self._original_title = ""
         self._bookmark_id = ""
+        self._html = html
         self.sanitized_content = ""
 
     def __getattr__(self, name):
@@ -50,6 +152,12 @@ class ExtendedBookmark(object):
     #
     # Adapting Bookmark properties
     #
+    @property
+    def html(self) -> Optional[str]:
+        if self._html is None:
+            self._html = self.bookmark.html
+        return self._html
+
     @property
     def bookmark_id(self) -> str:
         if not self._bookmark_id:
@@ -95,19 +203,23 @@ class ExtendedBookmark(object):
 
 class BookmarkDownloader(object):
 
-    def __init__(self, instapaper: Optional[Instapaper] = None):
+    def __init__(self, instapaper: Optional[Instapaper] = None, 
+                 books_folder: Path = Path('./books'), 
+                 image_cache: Optional[ImageCache] = None,
+                 http: Optional[requests.Session] = None):
         self.instapaper = instapaper
+        # Image requests go through http, so several downloaders can share one connection pool
+        self.http = http if http else requests
 
-        self.books_folder = Path('./books')
+        self.books_folder = books_folder
         self.books_folder.mkdir(exist_ok=True)
-        self.tmp_images_folder = Path('./tmp_images')
-        self.tmp_images_folder.mkdir(exist_ok=True)
+        # Several downloaders can share the image cache
+        self.image_cache = image_cache if image_cache else ImageCache(Path('./tmp_images'))
 
-    def login(self):
-        # TODO: Refactor to get configuration as parameters    
-        with open("oauth_config.json", "r") as f:
+    def login(self, config_folder: Path = Path('.')):
+        with open(config_folder / "oauth_config.json", "r") as f:
             oauth_config = json.load(f)
-        with open("user_credentials.json", "r") as f:
+        with open(config_folder / "user_credentials.json", "r") as f:
             user_credentials = json.load(f)
         self.instapaper = Instapaper(oauth_config['id'], oauth_config['secret'])
         self.instapaper.login(user_credentials['username'], user_credentials['password'])
@@ -116,8 +228,8 @@ class BookmarkDownloader(object):
         for bookmark in self.instapaper.bookmarks(limit=num_bookmarks_to_retrieve):
             self.download_bookmark_to_folder(bookmark, self.books_folder)
 
-    def download_bookmark_to_folder(self, bookmark, folder_path : Path):
-        bookmark = ExtendedBookmark(bookmark)
+    def download_bookmark_to_folder(self, bookmark, folder_path : Path, html: Optional[str] = None):
+        bookmark = ExtendedBookmark(bookmark, html)
         if self.bookmark_already_downloaded(bookmark):
             print(f'Skipping {bookmark.original_title}, as corresponding book already exists.')
             return
@@ -184,11 +296,16 @@ class BookmarkDownloader(object):
 
     def write_book(self, book: epub.EpubBook, book_file_name:str, folder_path: Path):
         book_file_path = folder_path / f'{book_file_name}.epub'
+        # Write to a temporary file first, so concurrent writers of the same book never see or remove each other's partial files
+        tmp_file_path = folder_path / f'{book_file_name}.epub.{uuid.uuid4().hex}.part'
         try: 
-            epub.write_epub(book_file_path, book, {})
+            writer = DeterministicEpubWriter(tmp_file_path, book, {})
+            writer.process()
+            writer.write()
+            tmp_file_path.replace(book_file_path)
         except Exception as e:
             print(f'Error writing book {book_file_name}: {e}')
-            book_file_path.unlink()
+            tmp_file_path.unlink(missing_ok=True)
             raise e
 
     #
@@ -199,11 +316,12 @@ class BookmarkDownloader(object):
         replaced_images = dict()
 
         images = soup.find_all('img')
-        images = set(filter(lambda i: i.has_attr('src') and not i['src'].startswith('data:'), images))
+        # Keep the document order, so that images are always added to the book in the same order
+        images = [i for i in images if i.has_attr('src') and not i['src'].startswith('data:')]
         for img in images:  
             image_url = urlparse(img['src']) 
             url_file_name = hashlib.md5(img['src'].encode('utf-8')).hexdigest() + image_url.path.split('/')[-1]
-            file_path = self.tmp_images_folder / url_file_name
+            file_path = Path(url_file_name)
             
             # Special Cases
             if (not file_path.suffix) or (file_path.suffix not in ('.jpg', '.jpeg', '.gif', '.png', '.bmp', '.tiff')):
@@ -217,11 +335,7 @@ class BookmarkDownloader(object):
             # Common Case        
             image_data = None
             try:
-                response = requests.get(img['src'])
-                response.raise_for_status()
-                
-                image_data = response.content
-                image_data = self.convert_image(image_data)
+                image_data = self.cached_image(img['src'], url_file_name)
                 self.add_image_to_book(book, url_file_name, image_data)
                 replaced_images[img['src']] = url_file_name
                 img['src'] = url_file_name
@@ -241,10 +355,50 @@ class BookmarkDownloader(object):
         else:
             return False
         
-    def convert_image(self, image_data) -> bytes:
+    def cached_image(self, url: str, url_file_name: str) -> bytes:
+        return self.image_cache.get(url_file_name, lambda: self.convert_image(self.fetch_image(url), url_file_name))
+
+    def fetch_image(self, url: str) -> bytes:
+        """Stream the image at url, rejecting it as soon as it is known to be too large or not an image."""
+        with self.http.get(url, stream=True, timeout=IMAGE_REQUEST_TIMEOUT) as response:
+            response.raise_for_status()
+
+            content_length = response.headers.get('Content-Length')
+            if content_length and content_length.isdigit() and int(content_length) > MAX_IMAGE_BYTES:
+                raise ValueError(f'Image {url} is too large ({content_length} bytes)')
+
+            parser = ImageFile.Parser()
+            image_data = bytearray()
+            for chunk in response.iter_content(chunk_size=IMAGE_CHUNK_SIZE):
+                image_data.extend(chunk)
+                if len(image_data) > MAX_IMAGE_BYTES:
+                    raise ValueError(f'Image {url} exceeds {MAX_IMAGE_BYTES} bytes')
+                if parser is not None:
+                    parser.feed(chunk)
+                    if parser.image:
+                        self.check_image_header(url, parser.image)
+                        parser = None
+                    elif len(image_data) >= IMAGE_PROBE_BYTES:
+                        raise ValueError(f'Could not identify image {url}')
+
+        return bytes(image_data)
+
+    def check_image_header(self, url: str, image: Image.Image) -> None:
+        width, height = image.size
+        if width * height > MAX_IMAGE_PIXELS:
+            raise ValueError(f'Image {url} has too many pixels ({width}x{height})')
+
+    def convert_image(self, image_data, file_name: str) -> bytes:
         image = Image.open(io.BytesIO(image_data))
+        # For JPEGs, let the decoder scale down while decoding instead of decoding at full resolution
+        image.draft('L', MAX_IMAGE_DIMENSIONS)
         image = image.convert('L')
-        return image.tobytes()
+        image.thumbnail(MAX_IMAGE_DIMENSIONS)
+        # Encode in the format of the file name, as the media type in the book is derived from it,
+        # servers do not always deliver the format the url suggests
+        converted_data = io.BytesIO()
+        image.save(converted_data, format=Image.registered_extensions()[Path(file_name).suffix.lower()])
+        return converted_data.getvalue()
 
     def add_image_to_book(self, book, url_file_name, image_data) -> None:
         img_path = Path(url_file_name)
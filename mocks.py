@@ -0,0 +1,91 @@
+"""Mocked Instapaper API and fixtures shared by the tests."""
+from instapaper import Instapaper
+from urllib.parse import parse_qs
+
+
+fixture_file_name = "InPa_Test_Bookmark_1.epub"
+fixture_file_contents = "test content"
+fixture_bookmark_data = dict(
+    bookmark_id=1,
+    title="Test Bookmark",
+    url="http://example.com",
+    starred=False,
+    html=fixture_file_contents
+)
+
+fixture_folders = {
+    "unread": dict(folder_id="unread", title="unread", bookmarks=[]),
+    "archive": dict(folder_id="archive", title="archive", bookmarks=[]),
+    "1": dict(folder_id="1", title="testfolder", bookmarks=[]),
+    "2": dict(folder_id="2", title="testfolder2", bookmarks=[]),
+}
+
+
+
+class MockedBookmark(object):
+    bookmark_id: int
+    title: str
+    url: str
+    starred: bool
+
+    def __init__(self, folders):
+        self.folders = folders
+
+    def unarchive(self):
+        self.move("unread")
+
+    def archive(self):
+        self.move("archive")
+
+    def move(self, folder_id):
+        for folder in self.folders.values():
+            if self in folder["bookmarks"]:
+                folder["bookmarks"].remove(self)
+        self.folders[folder_id]["bookmarks"].append(self)            
+
+class MockedInstapaper(Instapaper):
+
+    def __init__(self, folders, bookmark=None):
+        self._folders = folders
+        self.http = self
+        # Like the API, a bookmark that is not listed in any folder can still be changed
+        self.bookmark = bookmark
+
+    def request(self, url: str, method="GET", body=""):
+        # Bookmark objects created by the synchronizer call the API by bookmark id
+        params = {key: values[0] for key, values in parse_qs(body).items()}
+        bookmark = self.find_bookmark(int(params['bookmark_id'])) if 'bookmark_id' in params else None
+        if url.endswith("bookmarks/get_text"):
+            return {"status": "200"}, bookmark.html.encode("utf-8")
+        elif url.endswith("bookmarks/unarchive"):
+            bookmark.unarchive()
+        elif url.endswith("bookmarks/archive"):
+            bookmark.archive()
+        elif url.endswith("bookmarks/move"):
+            bookmark.move(params['folder_id'])
+        return {"status": "200"}, None
+
+    def find_bookmark(self, bookmark_id):
+        for folder in self._folders.values():
+            for bookmark in folder["bookmarks"]:
+                if bookmark.bookmark_id == bookmark_id:
+                    return bookmark
+        return self.bookmark
+
+    def folders(self):
+        # Like the API, only user created folders are listed
+        return [folder for folder_id, folder in self._folders.items() if folder_id not in ("unread", "archive")]
+
+    def bookmarks(self, folder="unread", limit=100, have=""):
+        have = [int(bookmark_id) for bookmark_id in have.split(",") if bookmark_id]
+        return [b for b in self._folders[folder]["bookmarks"] if b.bookmark_id not in have][:limit]
+
+
+def add_mocked_bookmarks(folders, folder_id, bookmark_ids):
+    bookmarks = []
+    for bookmark_id in bookmark_ids:
+        bookmark = MockedBookmark(folders)
+        bookmark.__dict__.update(fixture_bookmark_data, bookmark_id=bookmark_id)
+        bookmark.move(folder_id)
+        bookmarks.append(bookmark)
+    return bookmarks
@@ -0,0 +1,246 @@
+from instapaper import Bookmark
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from synchronize import BookmarkSynchronizer, SUCCESSFUL_RESULTS
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+WORK_QUEUE_FILE = "work_queue.sqlite"
+SHARD_SIZE = 50 # Number of local changes a worker claims at once
+SHARD_CLAIM_TIMEOUT = 5 * 60 # Seconds without heartbeat after which a claimed shard is considered abandoned and claimed again
+SHARD_HEARTBEAT_INTERVAL = 60 # Seconds between the heartbeats of a worker applying a shard
+SQLITE_TIMEOUT = 60
+
+class WorkQueue(object):
+    """Shards of work stored in a SQLite database. Workers in several processes, or on several machines
+    sharing the file system, claim shards one at a time until none is left."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        # Transactions are handled explicitly, so that claiming a shard takes the write lock right away
+        self.connection = sqlite3.connect(path, timeout=SQLITE_TIMEOUT, isolation_level=None)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS shards (
+            shard_id INTEGER PRIMARY KEY,
+            items TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            worker TEXT,
+            claimed_at REAL,
+            results TEXT)''')
+
+    def close(self):
+        self.connection.close()
+
+    def add_shards(self, shards: List[List[Dict]], results: Optional[Dict[int, str]] = None):
+        self.connection.execute("BEGIN IMMEDIATE")
+        self.connection.executemany("INSERT INTO shards (items) VALUES (?)", [(json.dumps(items),) for items in shards])
+        if results:
+            # Results known while planning, e.g. changes that can not be applied at all
+            self.connection.execute("INSERT INTO shards (items, status, results) VALUES ('[]', 'done', ?)", (json.dumps(results),))
+        self.connection.execute("COMMIT")
+
+    def claim(self, worker: str) -> Optional[Tuple[int, List[Dict]]]:
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.connection.execute(
+                "SELECT shard_id, items FROM shards WHERE status = 'pending' OR (status = 'claimed' AND claimed_at < ?) ORDER BY shard_id LIMIT 1",
+                (now - SHARD_CLAIM_TIMEOUT,)).fetchone()
+            if row:
+                self.connection.execute("UPDATE shards SET status = 'claimed', worker = ?, claimed_at = ? WHERE shard_id = ?", (worker, now, row[0]))
+        finally:
+            self.connection.execute("COMMIT")
+        if not row:
+            return None
+        return row[0], json.loads(row[1])
+
+    def heartbeat(self, shard_id: int, worker: str) -> bool:
+        """Mark the shard as still being worked on, returns False if the worker lost its claim."""
+        cursor = self.connection.execute("UPDATE shards SET claimed_at = ? WHERE shard_id = ? AND worker = ? AND status = 'claimed'",
+                                         (time.time(), shard_id, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, shard_id: int, worker: str, results: Dict[int, str]) -> bool:
+        """Store the results of the shard, returns False if the worker lost its claim and the results were dropped."""
+        cursor = self.connection.execute("UPDATE shards SET status = 'done', results = ? WHERE shard_id = ? AND worker = ? AND status = 'claimed'",
+                                         (json.dumps(results), shard_id, worker))
+        return cursor.rowcount == 1
+
+    def num_unfinished_shards(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM shards WHERE status != 'done'").fetchone()[0]
+
+    def results(self) -> Dict[int, str]:
+        results = {}
+        for (shard_results,) in self.connection.execute("SELECT results FROM shards WHERE status = 'done'"):
+            results.update({int(bookmark_id): result for bookmark_id, result in json.loads(shard_results).items()})
+        return results
+
+
+class ShardHeartbeat(object):
+    """Context manager refreshing the claim of a shard in the background while it is applied,
+    so that slow shards are not claimed again by other workers."""
+
+    def __init__(self, work_queue_file: Path, shard_id: int, worker: str):
+        self.work_queue_file = work_queue_file
+        self.shard_id = shard_id
+        self.worker = worker
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.beat, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+
+    def beat(self):
+        # SQLite connections can not be shared between threads
+        work_queue = WorkQueue(self.work_queue_file)
+        try:
+            while not self.stopped.wait(SHARD_HEARTBEAT_INTERVAL):
+                if not work_queue.heartbeat(self.shard_id, self.worker):
+                    return
+        finally:
+            work_queue.close()
+
+
+class ShardedSynchronizer(BookmarkSynchronizer):
+    """Splits synchronize into three phases: plan computes the changes and stores the local ones as shards
+    in a work queue, any number of workers apply the shards, and merge stores the resulting index.
+    Online changes are cheap and are applied while planning, before the work queue is written."""
+
+    def __init__(self, root: Path = Path('.'), **kwargs):
+        super().__init__(root, **kwargs)
+        self.work_queue_file = root / WORK_QUEUE_FILE
+
+    def plan(self) -> int:
+        if self.work_queue_file.exists():
+            raise Exception(f"There is an unmerged work plan in {self.work_queue_file}, merge it first.")
+
+        online_tree, bookmarks, local_tree, paths, local_diff, online_diff, local_folders = self.compute_diffs(self.online_folder_list())
+
+        print("-- Planning Local Changes --")
+        plan = self.plan_local_changes(local_tree, paths, bookmarks, local_diff, local_folders)
+        items = sorted(self.plan_to_items(plan), key=lambda item: item['bookmark_id'])
+        shards = [items[start:start + SHARD_SIZE] for start in range(0, len(items), SHARD_SIZE)]
+
+        # The online diff has to be applied before the work queue exists: merging a queue without it
+        # would store an index in which the local changes look like they were reverted online
+        print("-- Apply Online Diff --")
+        self.apply_diff_to_online_version(online_tree, bookmarks, online_diff)
+
+        work_queue = WorkQueue(self.work_queue_file)
+        try:
+            work_queue.add_shards(shards, plan['errors'])
+        finally:
+            work_queue.close()
+        print("Shards: ", len(shards))
+        return len(shards)
+
+    def work(self, worker: str) -> int:
+        """Apply shards until there are none left and return the number of applied shards."""
+        work_queue = WorkQueue(self.work_queue_file)
+        num_shards = 0
+        try:
+            while True:
+                shard = work_queue.claim(worker)
+                if not shard:
+                    return num_shards
+                shard_id, items = shard
+                print(f"{worker}: applying shard {shard_id}")
+                with ShardHeartbeat(self.work_queue_file, shard_id, worker):
+                    results = self.apply_local_plan(self.items_to_plan(items))
+                if work_queue.complete(shard_id, worker, results):
+                    num_shards += 1
+                else:
+                    print(f"{worker}: shard {shard_id} was claimed by another worker, its results were dropped", file=sys.stderr)
+        finally:
+            work_queue.close()
+
+    def merge(self) -> Dict[int, str]:
+        if not self.work_queue_file.exists():
+            raise Exception(f"There is no work plan in {self.work_queue_file}.")
+        work_queue = WorkQueue(self.work_queue_file)
+        try:
+            num_unfinished_shards = work_queue.num_unfinished_shards()
+            if num_unfinished_shards:
+                raise Exception(f"{num_unfinished_shards} shards are not applied yet.")
+            results = work_queue.results()
+        finally:
+            work_queue.close()
+
+        failed = {bookmark_id: result for bookmark_id, result in results.items() if result not in SUCCESSFUL_RESULTS}
+        print("Applied local changes: ", len(results) - len(failed))
+        print("Failed local changes: ", len(failed))
+
+        print("-- Storing Index --")
+        # Failed changes are not in the index, so they are planned again on the next run
+        self.store_index_tree(self.local_folder_list())
+        os.remove(self.work_queue_file)
+        return results
+
+    #
+    # Serializing the plan
+    #
+    def plan_to_items(self, plan: Dict) -> List[Dict]:
+        items = []
+        for bookmark_id, bookmark, folder in plan['downloads']:
+            items.append({'bookmark_id': bookmark_id, 'action': 'download',
+                          'bookmark': self.bookmark_to_checkpoint(bookmark), 'folder': self.relative_path(folder)})
+        for bookmark_id, source, target in plan['moves']:
+            items.append({'bookmark_id': bookmark_id, 'action': 'move',
+                          'source': self.relative_path(source), 'target': self.relative_path(target)})
+        for bookmark_id, path in plan['deletions']:
+            items.append({'bookmark_id': bookmark_id, 'action': 'delete', 'path': self.relative_path(path)})
+        return items
+
+    def items_to_plan(self, items: List[Dict]) -> Dict:
+        plan = {'moves': [], 'downloads': [], 'deletions': [], 'errors': {}}
+        for item in items:
+            if item['action'] == 'download':
+                plan['downloads'].append((item['bookmark_id'], Bookmark(self.instapaper, item['bookmark']), (self.root / item['folder']).absolute()))
+            elif item['action'] == 'move':
+                plan['moves'].append((item['bookmark_id'], self.root / item['source'], self.root / item['target']))
+            elif item['action'] == 'delete':
+                plan['deletions'].append((item['bookmark_id'], self.root / item['path']))
+            else:
+                plan['errors'][item['bookmark_id']] = f"Unknown action {item['action']}."
+        return plan
+
+    def relative_path(self, path: Path) -> str:
+        # Workers on other machines might mount the books folder somewhere else
+        return str(Path(path).absolute().relative_to(self.root.absolute()))
+
+
+def run_worker(worker: str):
+    synchronizer = ShardedSynchronizer()
+    synchronizer.login()
+    synchronizer.work(worker)
+
+
+if __name__ == '__main__':
+    commands = ('plan', 'work', 'merge')
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        sys.exit(f"Usage: {sys.argv[0]} plan | work [num_processes] | merge")
+
+    if sys.argv[1] == 'plan':
+        synchronizer = ShardedSynchronizer()
+        synchronizer.login()
+        synchronizer.plan()
+    elif sys.argv[1] == 'work':
+        num_processes = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+        worker_prefix = f"{socket.gethostname()}-{os.getpid()}"
+        workers = [multiprocessing.Process(target=run_worker, args=(f"{worker_prefix}-{i}",)) for i in range(num_processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    else:
+        ShardedSynchronizer().merge()
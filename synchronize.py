@@ -1,26 +1,51 @@
 from instapaper import Instapaper
 from instapaper import Bookmark
+from concurrent.futures import Executor, ThreadPoolExecutor, as_completed
 import shutil
-from typing import Dict, Tuple, AnyStr, Iterable, Optional
+from typing import Dict, Tuple, AnyStr, Iterable, Iterator, List, Optional, Set
 from pathlib import Path
-from download import BookmarkDownloader
+from download import BookmarkDownloader, ImageCache
 import json
+import requests
 import os
 import sys
+import threading
 import time
 
-NUM_BOOKMARKS_TO_SYNCHRONIZE = 500 # The maximum value the API allows
+BOOKMARKS_PAGE_SIZE = 500 # The maximum value the API allows
+CRAWL_CHECKPOINT_FILE = "crawl_checkpoint.jsonl"
+CRAWL_CHECKPOINT_MAX_AGE = 6 * 60 * 60 # Seconds after which an interrupted crawl is started over instead of resumed
+NUM_DOWNLOAD_WORKERS = 4
+SUCCESSFUL_RESULTS = ('moved', 'deleted', 'downloaded')
 
 class BookmarkSynchronizer(object):
 
-    def __init__(self):
+    def __init__(self, root: Path = Path('.'), 
+                 executor: Optional[Executor] = None, 
+                 http: Optional[requests.Session] = None, 
+                 image_cache: Optional[ImageCache] = None):
+        """All files of the account are kept in root. Several synchronizers can share the executor 
+        running the downloads, the http session, and the image cache."""
         self.instapaper : Optional[Instapaper] = None
         self.downloader : Optional[BookmarkDownloader] = None
+        self.api_lock = threading.Lock()
+
+        self.root = root
+        self.books_folder = root / 'books'
+        # Folders deleted online are moved here instead of being deleted
+        self.deleted_folder = self.books_folder / 'deleted'
+        self.deleted_folder.mkdir(parents=True, exist_ok=True)
+        self.index_file = root / 'index.json'
+        self.crawl_checkpoint_file = root / CRAWL_CHECKPOINT_FILE
+        self.image_cache = image_cache if image_cache else ImageCache(root / 'tmp_images')
+        self.executor = executor
+        self.http = http
+        self.resumed_crawl = False
 
     def login(self):
-        with open("oauth_config.json", "r") as f:
+        with open(self.root / "oauth_config.json", "r") as f:
             oauth_config = json.load(f)
-        with open("user_credentials.json", "r") as f:
+        with open(self.root / "user_credentials.json", "r") as f:
             user_credentials = json.load(f)
         self.instapaper = Instapaper(oauth_config['id'], oauth_config['secret'])
         self.instapaper.login(user_credentials['username'], user_credentials['password'])
@@ -31,14 +56,11 @@ class BookmarkSynchronizer(object):
     def local_folder_list(self):
         return [{'title' : f.name.split("_")[:-1], 
                     'folder_id': f.name.split("_")[-1], 
-                    'folder_path' : f} for f in Path('books').iterdir() if f.is_dir()]
+                    'folder_path' : f} for f in self.books_folder.iterdir() if f.is_dir() and f != self.deleted_folder]
 
 
     def synchronize(self):
-        online_folders = self.online_folder_list()
-        local_folders = self.local_folder_list()
-        self.synchronize_folders(online_folders, local_folders)
-        self.synchronize_bookmarks(online_folders, local_folders)
+        self.synchronize_bookmarks(self.online_folder_list())
 
     def synchronize_folders(self, online_folders, local_folders):
         online_folder_ids = [folder['folder_id'] for folder in online_folders]
@@ -51,12 +73,11 @@ class BookmarkSynchronizer(object):
             local_folders)
 
         for folder in folders_to_create:
-            (Path('books') / self.folder_to_directory_name(folder)).mkdir()
+            (self.books_folder / self.folder_to_directory_name(folder)).mkdir()
 
         for folder in folders_to_delete:
             # Move to not delete in case of error
-            shutil.move(Path('books') / self.folder_to_directory_name(folder), 
-                        Path('books') / 'deleted' / self.folder_to_directory_name(folder))
+            shutil.move(folder['folder_path'], self.deleted_folder / folder['folder_path'].name)
 
     def select_folders(self, folder_ids, folders):
         return [folder for folder in folders if folder['folder_id'] in folder_ids]
@@ -64,19 +85,31 @@ class BookmarkSynchronizer(object):
     def folder_to_directory_name(self, folder):
         return "_".join(folder['title'].split(" ")) + "_" + str(folder['folder_id'])
 
-    def synchronize_bookmarks(self, online_folders: Iterable[Dict], local_folders: Iterable[Dict]):
+    def synchronize_bookmarks(self, online_folders: Iterable[Dict]):
         """Actual synchronize: Three way merge between the online version, the local version, and a stored index"""
+        online_tree, bookmarks, local_tree, paths, local_diff, online_diff, local_folders = self.compute_diffs(online_folders)
+
+        # Step 3: Apply diff to local and online version, conflicts are resolved by favoring online version
+        print("-- Apply Diffs --")
+        self.apply_diff_to_local_version(local_tree, paths, bookmarks, local_diff, local_folders)
+        self.apply_diff_to_online_version(online_tree, bookmarks, online_diff)
+
+        # Step 4: Store resulting tree for next iteration
+        print("-- Storing Index --")
+        self.store_index_tree(local_folders)
+
+    def compute_diffs(self, online_folders: Iterable[Dict]) -> Tuple[Dict[int, AnyStr], Dict[int, Bookmark], Dict[int, AnyStr], Dict[int, Path], Dict, Dict, List[Dict]]:
+        """Synchronize the folders and diff the bookmarks, returning the online tree and bookmarks,
+        the local tree and paths, the local and online diff, and the local folders."""
+        self.synchronize_folders(online_folders, self.local_folder_list())
+        # Folders were created and removed, so list them again
+        local_folders = self.local_folder_list()
+
         # Step 1: Create a tree for online and local version
         print("-- Get Trees --")
         online_tree, bookmarks = self.create_tree_from_online_version(online_folders)
         local_tree, paths = self.create_tree_from_local_version(local_folders)
-        if os.path.exists("index.json"):
-            with open("index.json", "r") as f:
-                index_tree = json.load(f)
-                index_tree = {int(k): v for k, v in index_tree.items()}
-        else:
-            # In case there is no stored index, we use an empty dictionary. That way the diffing will interpret any inconsitencies as conflicts and resolve them by favoring the online version.
-            index_tree = dict()
+        index_tree = self.load_index_tree()
 
         print("Discovered online bookmarks: ", len(online_tree))
         print("Discovered local bookmarks: ", len(local_tree))
@@ -84,40 +117,132 @@ class BookmarkSynchronizer(object):
         # Step 2: Three-way-diff with tree stored in index (if there is no index then use the online tree) resulting in diff
         print("-- Start Diffing --")
         local_diff, online_diff = self.three_way_diff(online_tree, local_tree, index_tree)
+        local_diff = self.drop_deletions_after_resumed_crawl(local_diff)
 
         print("Online changes: ", len(online_diff))
         print("Local changes: ", len(local_diff))
+        return online_tree, bookmarks, local_tree, paths, local_diff, online_diff, local_folders
 
-        # Step 3: Apply diff to local and online version, conflicts are resolved by favoring online version
-        print("-- Apply Diffs --")
-        self.apply_diff_to_local_version(local_tree, paths, bookmarks, local_diff, local_folders)
-        self.apply_diff_to_online_version(online_tree, bookmarks, online_diff)
+    def load_index_tree(self) -> Dict[int, AnyStr]:
+        if os.path.exists(self.index_file):
+            with open(self.index_file, "r") as f:
+                index_tree = json.load(f)
+                return {int(k): v for k, v in index_tree.items()}
+        else:
+            # In case there is no stored index, we use an empty dictionary. That way the diffing will interpret any inconsitencies as conflicts and resolve them by favoring the online version.
+            return dict()
 
-        # Step 4: Store resulting tree for next iteration
-        print("-- Storing Index --")
+    def store_index_tree(self, local_folders: Iterable[Dict]):
         resulting_tree, _ = self.create_tree_from_local_version(local_folders)
-        with open("index.json", "w") as f:
+        with open(self.index_file, "w") as f:
             json.dump(resulting_tree, f)
     
 
     # Create tree by traversing folders and bookmarks, tree nodes contain bookmark id and bookmark object
     def create_tree_from_online_version(self, online_folders) -> Tuple[Dict[int, AnyStr], Dict[int, Bookmark]]:
-        tree : Dict[int, AnyStr] = {}
-        bookmarks : Dict[int, Bookmark]  = {}
+        """Crawl all bookmarks of all folders page by page. Each page is appended to a checkpoint file,
+        so an interrupted crawl continues where it stopped instead of starting over."""
+        tree, bookmarks, completed_folder_ids = self.load_crawl_checkpoint()
         folder_ids = [folder['folder_id'] for folder in online_folders]
-        for folder_id in folder_ids:
-            for bookmark in self.instapaper.bookmarks(folder=folder_id, limit=NUM_BOOKMARKS_TO_SYNCHRONIZE):
-                tree[bookmark.bookmark_id] = str(folder_id)
-                bookmarks[bookmark.bookmark_id] = bookmark
+        with open(self.crawl_checkpoint_file, "a") as checkpoint:
+            # Start on a fresh line in case the previous run was interrupted in the middle of a line
+            checkpoint.write("\n")
+            if not self.resumed_crawl:
+                self.write_crawl_checkpoint(checkpoint, {'started_at': time.time()})
+            for folder_id in folder_ids:
+                if folder_id in completed_folder_ids:
+                    continue
+                seen_ids = {bookmark_id for bookmark_id, tree_folder_id in tree.items() if tree_folder_id == folder_id}
+                for page in self.crawl_folder(folder_id, seen_ids):
+                    page_data = [self.bookmark_to_checkpoint(bookmark) for bookmark in page]
+                    for bookmark_data in page_data:
+                        tree[bookmark_data['bookmark_id']] = str(folder_id)
+                        # Only keep what is kept in the checkpoint as well, so memory stays small on large accounts
+                        bookmarks[bookmark_data['bookmark_id']] = Bookmark(self.instapaper, bookmark_data)
+                    self.write_crawl_checkpoint(checkpoint, {'folder_id': folder_id, 'bookmarks': page_data})
+                self.write_crawl_checkpoint(checkpoint, {'folder_id': folder_id, 'complete': True})
 
+        # The checkpoint only protects the crawl, a later run has to see the then current online version
+        os.remove(self.crawl_checkpoint_file)
         return tree, bookmarks
 
+    def crawl_folder(self, folder_id, seen_ids: Set[int]) -> Iterator[List[Bookmark]]:
+        """Yield pages of bookmarks, excluding all bookmarks seen so far via the have parameter to get past the API limit."""
+        while True:
+            response = self.instapaper.bookmarks(folder=folder_id, limit=BOOKMARKS_PAGE_SIZE, have=",".join(map(str, seen_ids)))
+            # Guard against the API ignoring have, which would otherwise never terminate
+            page = [bookmark for bookmark in response if bookmark.bookmark_id not in seen_ids]
+            if not page:
+                return
+            seen_ids.update(bookmark.bookmark_id for bookmark in page)
+            yield page
+            # Only a short response marks the end, a full one might have contained already seen bookmarks
+            if len(response) < BOOKMARKS_PAGE_SIZE:
+                return
+
+    def load_crawl_checkpoint(self) -> Tuple[Dict[int, AnyStr], Dict[int, Bookmark], Set[AnyStr]]:
+        tree : Dict[int, AnyStr] = {}
+        bookmarks : Dict[int, Bookmark] = {}
+        completed_folder_ids = set()
+        self.resumed_crawl = False
+        if not os.path.exists(self.crawl_checkpoint_file):
+            return tree, bookmarks, completed_folder_ids
+
+        with open(self.crawl_checkpoint_file, "r") as f:
+            entries = []
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # The last line might be incomplete if we were interrupted while writing it
+                    continue
+
+        started_at = entries[0].get('started_at', 0) if entries else 0
+        if time.time() - started_at > CRAWL_CHECKPOINT_MAX_AGE:
+            # Bookmarks might have moved between folders since then, which would then be missing from the tree
+            print("Discarding outdated crawl checkpoint")
+            os.remove(self.crawl_checkpoint_file)
+            return tree, bookmarks, completed_folder_ids
+
+        print("Resuming crawl from checkpoint")
+        self.resumed_crawl = True
+        for entry in entries:
+            if entry.get('complete'):
+                completed_folder_ids.add(entry['folder_id'])
+            for bookmark_data in entry.get('bookmarks', []):
+                tree[bookmark_data['bookmark_id']] = str(entry['folder_id'])
+                bookmarks[bookmark_data['bookmark_id']] = Bookmark(self.instapaper, bookmark_data)
+        return tree, bookmarks, completed_folder_ids
+
+    def drop_deletions_after_resumed_crawl(self, local_diff: Dict) -> Dict:
+        """A bookmark that moved online from a folder not crawled yet into one crawled before the interruption
+        is missing from a resumed crawl. It is only deleted locally once a complete crawl confirms it is gone."""
+        if not self.resumed_crawl:
+            return local_diff
+        kept_diff = {bookmark_id: folder_id for bookmark_id, folder_id in local_diff.items() if folder_id}
+        if len(kept_diff) < len(local_diff):
+            print(f"Postponing {len(local_diff) - len(kept_diff)} local deletions until the next complete crawl")
+        return kept_diff
+
+    def write_crawl_checkpoint(self, checkpoint, entry: Dict):
+        checkpoint.write(json.dumps(entry) + "\n")
+        checkpoint.flush()
+
+    def bookmark_to_checkpoint(self, bookmark: Bookmark) -> Dict:
+        # Only what is needed to download the bookmark later on
+        return {'bookmark_id': bookmark.bookmark_id, 'title': bookmark.title, 'url': bookmark.url}
+
     def create_tree_from_local_version(self, local_folders) -> Tuple[Dict[int, AnyStr], Dict[int, Path]]:
         tree = {}
         paths = {}
         for folder in map(lambda x: x['folder_path'], local_folders):
             folder_id = folder.name.split('_')[-1]
             for book in folder.iterdir():
+                if book.suffix != '.epub':
+                    # E.g. a book that is currently being written
+                    continue
                 book_id = int(book.stem.split('_')[-1]) # Extract bookmark id from filename
                 tree[book_id] = folder_id
                 paths[book_id] = book.absolute()
@@ -145,7 +270,7 @@ class BookmarkSynchronizer(object):
             elif local_folder != index_folder and online_folder != index_folder and local_folder != online_folder:
                 # Both changed and they disagree on the change
                 # -> we generally take the online version, but also apply our change in case the online
-                # version was or is not visible anymore due to the API limit
+                # version was or is not visible anymore (e.g. deleted online)
                 if online_folder == None:
                     online_diff[bookmark_id] = local_folder
                 local_diff[bookmark_id] = online_folder
@@ -159,29 +284,84 @@ class BookmarkSynchronizer(object):
         
         return local_diff, online_diff
 
-    def apply_diff_to_local_version(self, tree, paths: Dict[int, Path], bookmarks, local_diff : Dict, local_folders : Iterable[Dict]):
+    def apply_diff_to_local_version(self, tree, paths: Dict[int, Path], bookmarks, local_diff : Dict, local_folders : Iterable[Dict]) -> Dict[int, str]:
+        """Apply the local diff and return the outcome for each bookmark. Failures are reported, not raised,
+        so that the remaining entries are still applied and the failed ones are retried on the next run."""
+        plan = self.plan_local_changes(tree, paths, bookmarks, local_diff, local_folders)
+        return self.apply_local_plan(plan)
+
+    def apply_local_plan(self, plan: Dict) -> Dict[int, str]:
+        results = dict(plan['errors'])
+
+        executor = self.executor if self.executor else ThreadPoolExecutor(max_workers=NUM_DOWNLOAD_WORKERS)
+        try:
+            downloads = {executor.submit(self.download_bookmark_to_folder, bookmark, folder): bookmark_id
+                         for bookmark_id, bookmark, folder in plan['downloads']}
+            # Renames and deletions are cheap, so they run while the downloads are in progress
+            for bookmark_id, source, target in plan['moves']:
+                results[bookmark_id] = self.run_local_change(self.move_book, source, target, success='moved')
+            for bookmark_id, path in plan['deletions']:
+                results[bookmark_id] = self.run_local_change(path.unlink, success='deleted')
+            for future in as_completed(downloads):
+                results[downloads[future]] = self.run_local_change(future.result, success='downloaded')
+        finally:
+            # A shared executor is owned by whoever passed it in
+            if executor is not self.executor:
+                executor.shutdown()
+
+        for bookmark_id, result in results.items():
+            if result not in SUCCESSFUL_RESULTS:
+                print(f"Could not apply change to bookmark {bookmark_id}: {result}", file=sys.stderr)
+        return results
+
+    def plan_local_changes(self, tree, paths: Dict[int, Path], bookmarks, local_diff : Dict, local_folders : Iterable[Dict]) -> Dict[str, list]:
+        folder_paths = {folder['folder_id']: folder['folder_path'] for folder in local_folders}
+        plan = {'moves': [], 'downloads': [], 'deletions': [], 'errors': {}}
         for bookmark_id, folder_id in local_diff.items():
             if folder_id:
-                folders = [f for f in local_folders if f["folder_id"] == folder_id]
-                if not folders:
-                    sys.exit(f"Folder with id {folder_id} not found.")
-                folder = folders[0]["folder_path"]
+                if folder_id not in folder_paths:
+                    plan['errors'][bookmark_id] = f"Folder with id {folder_id} not found."
+                    continue
+                folder = folder_paths[folder_id]
                 if not bookmark_id in tree.keys():
                     # We do not yet have the book, download and store book
-                    self.download_bookmark_to_folder(bookmarks[bookmark_id], folder.absolute())
+                    plan['downloads'].append((bookmark_id, bookmarks[bookmark_id], folder.absolute()))
                 else:
                     # We have the book, move it to the folder
-                    shutil.move(paths[bookmark_id], folder / paths[bookmark_id].name)
+                    plan['moves'].append((bookmark_id, paths[bookmark_id], folder / paths[bookmark_id].name))
             else:
-                # The file does not exist online anymore (or was not delivered to us, due to the query limit)
-                paths[bookmark_id].unlink()
+                # The file does not exist online anymore
+                plan['deletions'].append((bookmark_id, paths[bookmark_id]))
+        return plan
+
+    def run_local_change(self, change, *args, success: str) -> str:
+        try:
+            change(*args)
+        except Exception as e:
+            return str(e) or e.__class__.__name__
+        return success
+
+    def move_book(self, source: Path, target: Path):
+        try:
+            # A plain rename is atomic and does not copy any data when staying on the same file system
+            source.rename(target)
+        except OSError:
+            shutil.move(source, target)
 
     def download_bookmark_to_folder(self, bookmark, folder_path : Path):
-        if not self.downloader:
-            self.downloader = BookmarkDownloader(self.instapaper)
-        self.downloader.download_bookmark_to_folder(bookmark, folder_path)
-        # Wait for 1 second to give server a break
-        time.sleep(1)
+        with self.api_lock:
+            if not self.downloader:
+                self.downloader = BookmarkDownloader(self.instapaper, 
+                                                     books_folder=self.books_folder, 
+                                                     image_cache=self.image_cache, 
+                                                     http=self.http)
+            # The API client is not thread-safe, so only the content request is serialized,
+            # images and books are then fetched and written concurrently.
+            # A failed request results in an empty text, so the client is never used outside the lock.
+            html = bookmark.html or ""
+            # Wait for 1 second to give server a break
+            time.sleep(1)
+        self.downloader.download_bookmark_to_folder(bookmark, folder_path, html)
 
     def synthesize_bookmark(self, bookmark_id):
         return Bookmark(self.instapaper, {"bookmark_id": bookmark_id})
@@ -0,0 +1,64 @@
+from pyfakefs.fake_filesystem_unittest import TestCase
+from unittest import mock
+from pathlib import Path
+from batch import BatchSynchronizer, FairExecutor
+import os
+import threading
+import unittest
+
+
+class FairExecutorTest(unittest.TestCase):
+
+    def test_tasks_are_taken_from_accounts_in_turn(self):
+        executor = FairExecutor(1)
+        started = threading.Event()
+        release = threading.Event()
+        order = []
+
+        def block():
+            started.set()
+            release.wait()
+        executor.submit("blocker", block)
+        started.wait()
+
+        futures = [executor.submit("a", order.append, f"a{i}") for i in range(3)]
+        futures += [executor.submit("b", order.append, f"b{i}") for i in range(2)]
+        release.set()
+        executor.shutdown()
+
+        self.assertEqual(order, ["a0", "b0", "a1", "b1", "a2"])
+        self.assertTrue(all(future.done() for future in futures))
+
+    def test_exceptions_are_set_on_future(self):
+        executor = FairExecutor(2)
+        future = executor.for_account("a").submit(int, "not a number")
+        executor.shutdown()
+        self.assertIsInstance(future.exception(), ValueError)
+
+
+class BatchSynchronizerTest(TestCase):
+
+    def setUp(self):
+        self.setUpPyfakefs()
+        self.fs.create_dir("/home/instapaper")
+        os.chdir('/home/instapaper')
+
+    def test_failing_account_does_not_stop_others(self):
+        synchronized = []
+
+        def synchronize_account(account_folder, executor, http, image_cache):
+            if account_folder == Path("broken"):
+                raise Exception("login failed")
+            synchronized.append(account_folder)
+
+        batch_synchronizer = BatchSynchronizer([Path("alice"), Path("broken"), Path("bob")], num_workers=2)
+        with mock.patch.object(batch_synchronizer, 'synchronize_account', side_effect=synchronize_account):
+            results = batch_synchronizer.synchronize()
+
+        self.assertEqual(sorted(synchronized), [Path("alice"), Path("bob")])
+        self.assertIsNone(results[Path("alice")])
+        self.assertEqual(str(results[Path("broken")]), "login failed")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,223 @@
+from pyfakefs.fake_filesystem_unittest import TestCase
+from unittest import mock
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from download import BookmarkDownloader
+import download
+import datetime
+import hashlib
+import io
+import os
+import threading
+import time
+import unittest
+import zipfile
+
+
+def image_bytes(size, format='JPEG'):
+    data = io.BytesIO()
+    Image.new('RGB', size, color=(200, 100, 50)).save(data, format=format)
+    return data.getvalue()
+
+
+class LaterDatetime(datetime.datetime):
+
+    @classmethod
+    def now(cls, tz=None):
+        return datetime.datetime(2030, 1, 1, tzinfo=tz)
+
+
+class MockedResponse(object):
+
+    def __init__(self, content, headers=None):
+        self.content = content
+        self.headers = headers or {}
+        self.read_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            self.read_bytes = start + chunk_size
+            yield self.content[start:start + chunk_size]
+
+
+class ImageDownloadTest(TestCase):
+
+    def setUp(self):
+        self.setUpPyfakefs()
+        self.fs.create_dir("/home/instapaper")
+        os.chdir('/home/instapaper')
+        self.downloader = BookmarkDownloader()
+        # Small limits, so that the tests get by with small payloads
+        for name, value in (('MAX_IMAGE_BYTES', 8192), ('IMAGE_PROBE_BYTES', 1024), ('IMAGE_CHUNK_SIZE', 256)):
+            patcher = mock.patch(f'download.{name}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def fetch(self, response):
+        with mock.patch('download.requests.get', return_value=response):
+            return self.downloader.fetch_image('http://example.com/image.jpg')
+
+    def test_fetch_image(self):
+        data = image_bytes((20, 10))
+        self.assertEqual(self.fetch(MockedResponse(data)), data)
+
+    def test_fetch_image_rejects_large_content_length(self):
+        response = MockedResponse(b'', headers={'Content-Length': str(download.MAX_IMAGE_BYTES + 1)})
+        with self.assertRaises(ValueError):
+            self.fetch(response)
+
+    def test_fetch_image_stops_at_max_bytes(self):
+        response = MockedResponse(image_bytes((20, 10)) + b'\0' * (download.MAX_IMAGE_BYTES + 1))
+        with self.assertRaises(ValueError):
+            self.fetch(response)
+        self.assertLessEqual(response.read_bytes, download.MAX_IMAGE_BYTES + download.IMAGE_CHUNK_SIZE)
+
+    def test_fetch_image_rejects_unknown_format_early(self):
+        response = MockedResponse(b'not an image' * 1000)
+        with self.assertRaises(ValueError):
+            self.fetch(response)
+        self.assertLessEqual(response.read_bytes, download.IMAGE_PROBE_BYTES + download.IMAGE_CHUNK_SIZE)
+
+    def test_fetch_image_rejects_too_many_pixels_early(self):
+        data = image_bytes((200, 100))
+        response = MockedResponse(data + b'\0' * download.MAX_IMAGE_BYTES)
+        self.assertLess(len(data), download.IMAGE_PROBE_BYTES)
+        with mock.patch('download.MAX_IMAGE_PIXELS', 100):
+            with self.assertRaises(ValueError):
+                self.fetch(response)
+        self.assertLessEqual(response.read_bytes, download.IMAGE_PROBE_BYTES)
+
+    def test_convert_image_shrinks_to_max_dimensions(self):
+        width, height = 60, 80
+        with mock.patch('download.MAX_IMAGE_DIMENSIONS', (width, height)):
+            data = self.downloader.convert_image(image_bytes((width * 4, height * 2)), 'image.jpg')
+        image = Image.open(io.BytesIO(data))
+        self.assertEqual(image.format, 'JPEG')
+        self.assertEqual(image.mode, 'L')
+        self.assertLessEqual(image.size[0], width)
+        self.assertLessEqual(image.size[1], height)
+
+    def test_convert_image_uses_format_of_file_name(self):
+        for served_format, file_name, expected_format in (('PNG', 'image.jpg', 'JPEG'), ('JPEG', 'image.png', 'PNG'), ('WEBP', 'image.gif', 'GIF')):
+            data = self.downloader.convert_image(image_bytes((20, 10), served_format), file_name)
+            self.assertEqual(Image.open(io.BytesIO(data)).format, expected_format)
+
+    def test_image_in_book_matches_its_media_type(self):
+        with mock.patch.object(self.downloader, 'fetch_image', return_value=image_bytes((20, 10), 'PNG')):
+            book = self.downloader.create_full_book("1", "Test Bookmark", '<img src="http://example.com/image.jpg"/>')
+        image, = book.get_items_of_media_type('image/jpeg')
+        self.assertEqual(Image.open(io.BytesIO(image.content)).format, 'JPEG')
+
+
+class ImageCacheTest(TestCase):
+
+    def setUp(self):
+        self.setUpPyfakefs()
+        self.image_cache = download.ImageCache(Path('/tmp_images'))
+
+    def test_concurrent_requests_create_image_once(self):
+        release = threading.Event()
+        created = []
+
+        def create():
+            created.append(1)
+            release.wait()
+            return b'image'
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(self.image_cache.get, 'a.png', create) for _ in range(4)]
+            time.sleep(0.1)
+            release.set()
+            results = [future.result() for future in futures]
+
+        self.assertEqual(results, [b'image'] * 4)
+        self.assertEqual(len(created), 1)
+        self.assertEqual(self.image_cache.get('a.png', lambda: b'other'), b'image')
+
+    def test_failures_are_not_cached(self):
+        def fail():
+            raise ValueError('not an image')
+
+        with self.assertRaises(ValueError):
+            self.image_cache.get('a.png', fail)
+        self.assertEqual(self.image_cache.get('a.png', lambda: b'image'), b'image')
+
+
+class ExtendedBookmarkTest(unittest.TestCase):
+
+    def test_passed_html_is_not_fetched_again(self):
+        bookmark = mock.Mock(spec=['bookmark_id', 'title', 'url'])
+        extended_bookmark = download.ExtendedBookmark(bookmark, "")
+        extended_bookmark.get_and_sanitize_content()
+        self.assertEqual(extended_bookmark.sanitized_content, "no content")
+
+
+class DeterministicZipFileTest(unittest.TestCase):
+
+    def zipped_size(self, compresslevel):
+        data = io.BytesIO()
+        with download.DeterministicZipFile(data, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zip_file:
+            zip_file.writestr('chapter.xhtml', ''.join(f'<p>Paragraph {i}</p>' for i in range(2000)))
+        return len(data.getvalue())
+
+    def test_compresslevel_is_applied(self):
+        self.assertGreater(self.zipped_size(1), self.zipped_size(9))
+
+
+class DeterministicBookTest(TestCase):
+
+    def setUp(self):
+        self.setUpPyfakefs()
+        self.fs.create_dir("/home/instapaper")
+        os.chdir('/home/instapaper')
+        self.downloader = BookmarkDownloader()
+        self.content = '<p>Some text</p><img src="http://example.com/b.png"/><img src="http://example.com/a.png"/>' * 20
+        self.image_data = os.urandom(1000) # Does not compress, just like most real images
+
+    def write_book(self, file_name):
+        with mock.patch.object(self.downloader, 'cached_image', return_value=self.image_data):
+            book = self.downloader.create_full_book("1", "Test Bookmark", self.content)
+        self.downloader.write_book(book, file_name, Path('/home/instapaper/books'))
+        return Path(f'/home/instapaper/books/{file_name}.epub').read_bytes()
+
+    def test_book_is_byte_identical(self):
+        first = self.write_book("first")
+        # EbookLib stamps the book with the current time unless told otherwise
+        with mock.patch('datetime.datetime', LaterDatetime):
+            second = self.write_book("second")
+        self.assertEqual(hashlib.sha256(first).hexdigest(), hashlib.sha256(second).hexdigest())
+
+    def test_book_modification_time_is_fixed(self):
+        with zipfile.ZipFile(io.BytesIO(self.write_book("book"))) as book:
+            opf = book.read('EPUB/content.opf').decode('utf-8')
+        self.assertIn(f'<meta property="dcterms:modified">{download.EPUB_TIMESTAMP:%Y-%m-%dT%H:%M:%SZ}</meta>', opf)
+
+    def test_book_is_written_without_leftover_files(self):
+        self.write_book("book")
+        self.assertEqual(os.listdir('/home/instapaper/books'), ['book.epub'])
+
+    def test_book_entries(self):
+        with zipfile.ZipFile(io.BytesIO(self.write_book("book"))) as book:
+            entries = book.infolist()
+        self.assertEqual(entries[0].filename, 'mimetype')
+        self.assertEqual(entries[0].compress_type, zipfile.ZIP_STORED)
+        for entry in entries:
+            self.assertEqual(entry.date_time, download.EPUB_TIMESTAMP.timetuple()[:6])
+            if entry.filename.endswith('.png'):
+                self.assertEqual(entry.compress_type, zipfile.ZIP_STORED)
+            elif entry.filename.endswith('.xhtml'):
+                self.assertEqual(entry.compress_type, zipfile.ZIP_DEFLATED)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+from pathlib import Path
+from unittest import mock
+from copy import deepcopy
+from mocks import MockedInstapaper, add_mocked_bookmarks, fixture_folders
+from shard import ShardedSynchronizer, WorkQueue
+import json
+import shard
+import tempfile
+import time
+import unittest
+
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.work_queue = WorkQueue(Path(self.tmp_dir.name) / shard.WORK_QUEUE_FILE)
+
+    def tearDown(self):
+        self.work_queue.close()
+        self.tmp_dir.cleanup()
+
+    def test_shards_are_claimed_once(self):
+        self.work_queue.add_shards([[{"bookmark_id": 1}], [{"bookmark_id": 2}]], {3: "Folder with id 9 not found."})
+        self.assertEqual(self.work_queue.claim("a"), (1, [{"bookmark_id": 1}]))
+        self.assertEqual(self.work_queue.claim("b"), (2, [{"bookmark_id": 2}]))
+        self.assertIsNone(self.work_queue.claim("c"))
+        self.assertEqual(self.work_queue.num_unfinished_shards(), 2)
+
+        self.assertTrue(self.work_queue.complete(1, "a", {1: "moved"}))
+        self.assertTrue(self.work_queue.complete(2, "b", {2: "downloaded"}))
+        self.assertEqual(self.work_queue.num_unfinished_shards(), 0)
+        self.assertEqual(self.work_queue.results(), {1: "moved", 2: "downloaded", 3: "Folder with id 9 not found."})
+
+    def test_abandoned_shards_are_claimed_again(self):
+        self.work_queue.add_shards([[{"bookmark_id": 1}]])
+        self.assertIsNotNone(self.work_queue.claim("a"))
+        with mock.patch('shard.SHARD_CLAIM_TIMEOUT', -1):
+            self.assertEqual(self.work_queue.claim("b"), (1, [{"bookmark_id": 1}]))
+        # The abandoning worker can not complete the shard anymore
+        self.assertFalse(self.work_queue.heartbeat(1, "a"))
+        self.assertFalse(self.work_queue.complete(1, "a", {1: "moved"}))
+        self.assertEqual(self.work_queue.num_unfinished_shards(), 1)
+
+    def test_heartbeat_keeps_claim(self):
+        self.work_queue.add_shards([[{"bookmark_id": 1}]])
+        self.assertIsNotNone(self.work_queue.claim("a"))
+        with mock.patch('shard.SHARD_HEARTBEAT_INTERVAL', 0.01):
+            with shard.ShardHeartbeat(self.work_queue.path, 1, "a"):
+                time.sleep(0.1)
+                # A shard taking longer than the timeout stays claimed, as long as its worker is alive
+                with mock.patch('shard.SHARD_CLAIM_TIMEOUT', 0.05):
+                    self.assertIsNone(self.work_queue.claim("b"))
+        self.assertTrue(self.work_queue.complete(1, "a", {1: "moved"}))
+
+
+class ShardedSynchronizerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+        self.folders = deepcopy(fixture_folders)
+        for folder in self.folders.values():
+            (self.root / "books" / f'{folder["title"]}_{folder["folder_id"]}').mkdir(parents=True)
+
+        self.bookmarks = add_mocked_bookmarks(self.folders, "archive", range(1, 6))
+        for bookmark in self.bookmarks:
+            (self.root / "books" / "unread_unread" / f"InPa_Test_Bookmark_{bookmark.bookmark_id}.epub").write_text("test content")
+        (self.root / "index.json").write_text(json.dumps({b.bookmark_id: "unread" for b in self.bookmarks}))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def create_synchronizer(self):
+        synchronizer = ShardedSynchronizer(self.root)
+        synchronizer.instapaper = MockedInstapaper(self.folders)
+        return synchronizer
+
+    def test_plan_work_merge(self):
+        with mock.patch('shard.SHARD_SIZE', 2):
+            self.assertEqual(self.create_synchronizer().plan(), 3)
+        with self.assertRaises(Exception):
+            self.create_synchronizer().plan()
+
+        self.assertEqual(self.create_synchronizer().work("a"), 3)
+        results = self.create_synchronizer().merge()
+
+        self.assertEqual(results, {b.bookmark_id: "moved" for b in self.bookmarks})
+        self.assertEqual(len(list((self.root / "books" / "archive_archive").iterdir())), 5)
+        self.assertEqual(json.loads((self.root / "index.json").read_text()), {str(b.bookmark_id): "archive" for b in self.bookmarks})
+        self.assertFalse((self.root / shard.WORK_QUEUE_FILE).exists())
+
+    def test_no_work_queue_if_online_diff_fails(self):
+        synchronizer = self.create_synchronizer()
+        with mock.patch.object(synchronizer, 'apply_diff_to_online_version', side_effect=Exception("network error")):
+            with self.assertRaises(Exception):
+                synchronizer.plan()
+        self.assertFalse((self.root / shard.WORK_QUEUE_FILE).exists())
+
+    def test_merge_waits_for_unfinished_shards(self):
+        self.create_synchronizer().plan()
+        with self.assertRaises(Exception):
+            self.create_synchronizer().merge()
+        self.assertTrue((self.root / shard.WORK_QUEUE_FILE).exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,10 +2,16 @@ from pyfakefs.fake_filesystem_unittest import TestCase
 import os
 from copy import deepcopy
 import json
+import time
+from instapaper import Bookmark
 from synchronize import BookmarkSynchronizer
-from instapaper import Instapaper
+import synchronize
+from mocks import MockedBookmark, MockedInstapaper, add_mocked_bookmarks
+from mocks import fixture_file_name, fixture_file_contents, fixture_bookmark_data, fixture_folders
 import unittest
 from typing import Optional
+from pathlib import Path
+from unittest import mock
 
 # Full table of diffing cases
 # | online | local | index |  
@@ -57,64 +63,6 @@ from typing import Optional
 # |   -    |   -   |   x   | both deleted
 
 
-fixture_file_name = "InPa_Test_Bookmark_1.epub"
-fixture_file_contents = "test content"
-fixture_bookmark_data = dict(
-    bookmark_id=1,
-    title="Test Bookmark",
-    url="http://example.com",
-    starred=False,
-    html=fixture_file_contents
-)
-
-fixture_folders = {
-    "unread": dict(folder_id="unread", title="unread", bookmarks=[]),
-    "archive": dict(folder_id="archive", title="archive", bookmarks=[]),
-    "1": dict(folder_id="1", title="testfolder", bookmarks=[]),
-    "2": dict(folder_id="2", title="testfolder2", bookmarks=[]),
-}
-
-
-
-class MockedBookmark(object):
-    bookmark_id: int
-    title: str
-    url: str
-    starred: bool
-
-    def __init__(self, folders):
-        self.folders = folders
-
-    def unarchive(self):
-        self.move("unread")
-
-    def archive(self):
-        self.move("archive")
-
-    def move(self, folder_id):
-        for folder in self.folders.values():
-            if self in folder["bookmarks"]:
-                folder["bookmarks"].remove(self)
-        self.folders[folder_id]["bookmarks"].append(self)            
-
-class MockedInstapaper(Instapaper):
-
-    def __init__(self, folders, bookmark):
-        self._folders = folders
-        self.http = self
-        self.bookmark = bookmark
-
-    def request(self, url: str, **kwargs):
-        if url.find("archive") > -1:
-            self.bookmark.archive()
-        return {"status": "200"}, None
-
-    def folders(self):
-        return self._folders.values()
-
-    def bookmarks(self, folder="unread", limit=100):
-        return self._folders[folder]["bookmarks"]
-
 class SynchronizationTest(TestCase):
 
     def setUp(self):
@@ -303,5 +251,123 @@ class SynchronizationTest(TestCase):
         self.synchronizer.synchronize()
         self.assert_state(online="archive", local="archive", index="archive")
 
+    #
+    # Tests for applying local changes
+    #
+    def test_apply_local_diff_reports_missing_folder(self):
+        self.state_before(online="1", local="1", index="1")
+        local_folders = self.synchronizer.local_folder_list()
+        local_tree, paths = self.synchronizer.create_tree_from_local_version(local_folders)
+        results = self.synchronizer.apply_diff_to_local_version(local_tree, paths, {}, {1: "99"}, local_folders)
+        self.assertEqual(results, {1: "Folder with id 99 not found."})
+        self.assert_bookmark_local_in_folder("1")
+
+    def test_apply_local_diff_continues_after_failure(self):
+        self.state_before(online="1", local="1", index="1")
+        local_folders = self.synchronizer.local_folder_list()
+        local_tree, paths = self.synchronizer.create_tree_from_local_version(local_folders)
+        results = self.synchronizer.apply_diff_to_local_version(local_tree, paths, {}, {2: "99", 1: "archive"}, local_folders)
+        self.assertEqual(results[1], "moved")
+        self.assertNotEqual(results[2], "moved")
+        self.assert_bookmark_local_in_folder("archive")
+
+    def test_synchronize_in_account_folder(self):
+        self.fs.create_dir('/home/other/books/unread_unread')
+        self.fs.create_dir('/home/other/books/archive_archive')
+        self.folders = {folder_id: self.folders[folder_id] for folder_id in ("unread", "archive")}
+        self.bookmark_online_folder("archive")
+        synchronizer = BookmarkSynchronizer(Path('/home/other'))
+        synchronizer.instapaper = MockedInstapaper(self.folders, self.bookmark)
+        synchronizer.synchronize()
+        self.assertTrue(os.path.exists(f'/home/other/books/archive_archive/{fixture_file_name}'))
+        self.assertTrue(os.path.exists('/home/other/index.json'))
+        self.assertFalse(os.path.exists('/home/instapaper/index.json'))
+
+    def test_synchronize_in_new_account_folder(self):
+        self.fs.create_dir('/home/new')
+        self.bookmark_online_folder("1")
+        synchronizer = BookmarkSynchronizer(Path('/home/new'))
+        synchronizer.instapaper = MockedInstapaper(self.folders, self.bookmark)
+        synchronizer.synchronize()
+        synchronizer.synchronize()
+        self.assertTrue(os.path.exists(f'/home/new/books/testfolder_1/{fixture_file_name}'))
+        self.assertFalse(os.path.exists('/home/new/books/deleted/deleted_deleted'))
+
+    def test_folder_deleted_online(self):
+        del self.folders["2"]
+        self.synchronizer.synchronize()
+        self.assertTrue(os.path.exists('/home/instapaper/books/deleted/testfolder2_2'))
+        self.assertFalse(os.path.exists('/home/instapaper/books/testfolder2_2'))
+
+    #
+    # Tests for crawling the online version
+    #
+    def add_online_bookmarks(self, folder_id, bookmark_ids):
+        add_mocked_bookmarks(self.folders, folder_id, bookmark_ids)
+
+    def test_crawl_beyond_page_size(self):
+        self.add_online_bookmarks("1", range(10, 15))
+        self.add_online_bookmarks("archive", range(20, 23))
+        with mock.patch('synchronize.BOOKMARKS_PAGE_SIZE', 2):
+            tree, bookmarks = self.synchronizer.create_tree_from_online_version(self.synchronizer.online_folder_list())
+        self.assertEqual(tree, {**{i: "1" for i in range(10, 15)}, **{i: "archive" for i in range(20, 23)}})
+        self.assertEqual(set(bookmarks.keys()), set(tree.keys()))
+        self.assertFalse(os.path.exists(synchronize.CRAWL_CHECKPOINT_FILE))
+
+    def test_crawl_only_keeps_checkpoint_data(self):
+        self.add_online_bookmarks("1", [10])
+        _, bookmarks = self.synchronizer.create_tree_from_online_version(self.synchronizer.online_folder_list())
+        self.assertIsInstance(bookmarks[10], Bookmark)
+        self.assertEqual((bookmarks[10].bookmark_id, bookmarks[10].title, bookmarks[10].url), (10, "Test Bookmark", "http://example.com"))
+        self.assertFalse(hasattr(bookmarks[10], 'folders'))
+
+    def test_crawl_continues_after_page_with_seen_bookmarks(self):
+        self.add_online_bookmarks("1", range(10, 15))
+        pages = [self.folders["1"]["bookmarks"][0:2], self.folders["1"]["bookmarks"][1:3], self.folders["1"]["bookmarks"][3:5], []]
+        with mock.patch.object(self.synchronizer.instapaper, 'bookmarks', side_effect=pages):
+            with mock.patch('synchronize.BOOKMARKS_PAGE_SIZE', 2):
+                crawled = [b.bookmark_id for page in self.synchronizer.crawl_folder("1", set()) for b in page]
+        self.assertEqual(crawled, list(range(10, 15)))
+
+    def test_crawl_resumes_from_checkpoint(self):
+        self.add_online_bookmarks("1", range(10, 15))
+        checkpoint = [
+            {"started_at": time.time()},
+            {"folder_id": "unread", "complete": True},
+            {"folder_id": "1", "bookmarks": [{"bookmark_id": 10, "title": "Old Title", "url": "http://example.com"}]},
+            '{"folder_id": "1", "bookm',
+        ]
+        self.fs.create_file(f'/home/instapaper/{synchronize.CRAWL_CHECKPOINT_FILE}',
+                            contents="\n".join(e if isinstance(e, str) else json.dumps(e) for e in checkpoint))
+        self.add_online_bookmarks("unread", [30])
+        with mock.patch('synchronize.BOOKMARKS_PAGE_SIZE', 2):
+            tree, bookmarks = self.synchronizer.create_tree_from_online_version(self.synchronizer.online_folder_list())
+        self.assertEqual(tree, {i: "1" for i in range(10, 15)})
+        self.assertEqual(bookmarks[10].title, "Old Title")
+        self.assertFalse(os.path.exists(synchronize.CRAWL_CHECKPOINT_FILE))
+
+    def test_crawl_discards_outdated_checkpoint(self):
+        self.add_online_bookmarks("1", [10])
+        checkpoint = [
+            {"started_at": time.time() - synchronize.CRAWL_CHECKPOINT_MAX_AGE - 1},
+            {"folder_id": "unread", "bookmarks": [{"bookmark_id": 5, "title": "Moved", "url": "http://example.com"}]},
+            {"folder_id": "unread", "complete": True},
+        ]
+        self.fs.create_file(f'/home/instapaper/{synchronize.CRAWL_CHECKPOINT_FILE}',
+                            contents="\n".join(json.dumps(e) for e in checkpoint))
+        tree, _ = self.synchronizer.create_tree_from_online_version(self.synchronizer.online_folder_list())
+        self.assertEqual(tree, {10: "1"})
+        self.assertFalse(self.synchronizer.resumed_crawl)
+
+    def test_resumed_crawl_postpones_local_deletions(self):
+        """The bookmark might have moved online from a folder crawled after the interruption into one crawled before."""
+        self.state_before(online=None, local="unread", index="unread")
+        self.fs.create_file(f'/home/instapaper/{synchronize.CRAWL_CHECKPOINT_FILE}',
+                            contents="\n".join(json.dumps(e) for e in [{"started_at": time.time()}, {"folder_id": "unread", "complete": True}]))
+        self.synchronizer.synchronize()
+        self.assert_state(online=None, local="unread", index="unread")
+        self.synchronizer.synchronize()
+        self.assert_state(online=None, local=None, index=None)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file